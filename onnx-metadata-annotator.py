@@ -7,8 +7,10 @@ Application for adding custom metadata to an ONNX model.
 import argparse
 import json
 import os
+import re
 import sys
 
+from json.encoder import encode_basestring_ascii
 from pathlib import Path
 from typing import Any, Dict, Type
 
@@ -19,6 +21,13 @@ except ImportError:
     sys.stderr.write(MSG)
     sys.exit(1)
 
+from onnx.external_data_helper import load_external_data_for_model, uses_external_data
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Global Variables
 METADATA = {
     "model_type": 'String: Object Detection, Pixel Segmentation, etc.',
@@ -36,6 +45,8 @@ METADATA = {
     "image_height": 'Integer: Value indicating the height of the input image.'
 }
 
+METADATA_KEYS = frozenset(METADATA)
+
 TYPES = {
     "model_type": str, "model_architecture": str, "number_of_classes": int,
     "number_of_bands": int, "number_of_epochs": int, "class_names": list,
@@ -43,14 +54,25 @@ TYPES = {
     "model_version": int, "model_date": str
 }
 
+# (key, expected type or None, template value) for each metadata key
+VALIDATION_TABLE = tuple(
+    (key, TYPES.get(key), template) for (key, template) in METADATA.items()
+)
+
 # All licensing must be verified, this is a way to
 # support vendors regarding unsupported licensing.
-NON_PERMISIVE_LICENSES = [
+NON_PERMISIVE_LICENSES = (
     "GPL", "AGPL", "LGPL",
     "CC BY-NC", "CC BY-NC-SA",
     "CC BY-ND", "CC BY-NC-ND",
     "GNU", "APSL", "EPL", "MPL"
-]
+)
+
+# Matches any non-permissive license at the start of a word, e.g., GPLv3
+NON_PERMISIVE_LICENSES_RE = re.compile(
+    r'\b(?:' + '|'.join(re.escape(npl) for npl in NON_PERMISIVE_LICENSES) + ')',
+    re.IGNORECASE
+)
 
 # ANSI escape sequences for colors
 COLORS = {
@@ -62,14 +84,17 @@ COLORS = {
     "reset": "\033[0m"
 }
 
+# Colors are only written to terminals, redirected output stays plain text
+_COLOR_STDOUT = sys.stdout.isatty()
+_RED, _RESET = (COLORS['red'], COLORS['reset']) if sys.stderr.isatty() else ('', '')
+
 def _error(message: str) -> None:
     """Simple helper function to report console _error and exit.
 
     Args:
         message (str): _error reported due to failure.
     """
-    err = f'{COLORS.get("red", COLORS["reset"])}Error: {message}{COLORS["reset"]}\n'
-    sys.stderr.write(err)
+    sys.stderr.write(f'{_RED}Error: {message}{_RESET}\n')
     sys.exit(1)
 
 
@@ -80,6 +105,8 @@ def _to_color(message: str, color: str="white") -> str:
         message (str): text where color is applied.
         color (str): color to change text too, defaults to white.
     """
+    if not _COLOR_STDOUT:
+        return message
     return f'{COLORS.get(color, COLORS["reset"])}{message}{COLORS["reset"]}'
 
 
@@ -93,11 +120,73 @@ def _add_metadata(
         model (ModelProto): a loaded ONNX model.
         dict_data (dict): flat dictionary with str: str key values.
     """
+    # Strings are quoted directly, same output as json.dumps without the encoder setup
+    entries = [
+        onnx.StringStringEntryProto(
+            key=key,
+            value=encode_basestring_ascii(value) if isinstance(value, str) else json.dumps(value)
+        )
+        for (key, value) in dict_data.items()
+    ]
     del model.metadata_props[:]
-    for (key, value) in dict_data.items():
-        entry = model.metadata_props.add()
-        entry.key = key
-        entry.value = json.dumps(value)
+    model.metadata_props.extend(entries)
+
+
+def _graph_tensors(graph: onnx.GraphProto):
+    """Yield every tensor in a graph, including node attribute tensors and
+    tensors of nested subgraphs.
+
+    Args:
+        graph (GraphProto): an ONNX graph.
+    """
+    yield from graph.initializer
+    for node in graph.node:
+        for attr in node.attribute:
+            if attr.HasField('t'):
+                yield attr.t
+            yield from attr.tensors
+            if attr.HasField('g'):
+                yield from _graph_tensors(attr.g)
+            for subgraph in attr.graphs:
+                yield from _graph_tensors(subgraph)
+
+
+def _save_model(
+        model: onnx.ModelProto,
+        model_uri: Path,
+        output_uri: Path
+) -> None:
+    """Save a model loaded without external data. When tensors are stored
+    externally and the output stays next to the source model, only the graph
+    proto is rewritten and the existing external data files are reused.
+
+    Args:
+        model (ModelProto): an ONNX model loaded with load_external_data=False.
+        model_uri (Path): source ONNX model path.
+        output_uri (Path): output ONNX model path.
+    """
+    external = any(
+        uses_external_data(tensor) for tensor in _graph_tensors(model.graph)
+    )
+    output_uri = Path(output_uri)
+
+    if not external or output_uri.resolve().parent == model_uri.resolve().parent:
+        onnx.save(model, output_uri)
+    else:
+        # External data locations are relative, gather the tensors for the new location
+        load_external_data_for_model(model, str(model_uri.parent))
+
+        # onnx appends to an existing data file, remove stale tensors first
+        location = f'{output_uri.name}.data'
+        output_uri.with_name(location).unlink(missing_ok=True)
+        onnx.save(
+            model,
+            output_uri,
+            save_as_external_data=True,
+            all_tensors_to_one_file=True,
+            location=location,
+            convert_attribute=True
+        )
 
 
 def _metadata_validator(metadata: Dict[str, Any]) -> None:
@@ -109,23 +198,24 @@ def _metadata_validator(metadata: Dict[str, Any]) -> None:
         metadata (dict): user provided JSON configuration of metadata.
     """
     # Validate expected metadata keys
-    keys = list(metadata.keys())
-    meta_keys = list(METADATA.keys())
-    if not set(meta_keys).issubset(keys):
-        diff = set(meta_keys) - set(keys)
-        _error(f'Missing configuration key(s): {str(diff)}')
+    missing = METADATA_KEYS.difference(metadata)
+    if missing:
+        _error(f'Missing configuration key(s): {", ".join(sorted(missing))}')
 
-    # Validate no empty values, no template values, and expected types
+    # Validate no empty values, including keys outside the template
     for (key, value) in metadata.items():
         if value is None or value == "":
             _error(f'Invalid empty value for key: {key}')
 
-        if key in TYPES and not isinstance(metadata[key], TYPES[key]):
-            _error(f'Metadata {key} should be {TYPES[key]}.')
+    # Validate expected types and no template values
+    metadata_get = metadata.get
+    for (key, expected_type, template) in VALIDATION_TABLE:
+        value = metadata_get(key)
+        if expected_type is not None and not isinstance(value, expected_type):
+            _error(f'Metadata {key} should be {expected_type}.')
 
-        if isinstance(metadata[key], str):
-            if METADATA[key] in metadata[key]:
-                _error(f'Configuration key {key} value matches the template, please update.')
+        if isinstance(value, str) and template in value:
+            _error(f'Configuration key {key} value matches the template, please update.')
 
     # Validate number_of_classes match class_names count
     n_class_names = len(metadata['class_names'])
@@ -136,10 +226,9 @@ def _metadata_validator(metadata: Dict[str, Any]) -> None:
         _error(msg)
 
     # Check licensing
-    lic = metadata['model_license'].upper()
-    for npl in NON_PERMISIVE_LICENSES:
-        if lic.find(npl) > 0:
-            _error(f"Non commercial license {lic} detected.")
+    lic = metadata['model_license']
+    if NON_PERMISIVE_LICENSES_RE.search(lic):
+        _error(f"Non commercial license {lic} detected.")
 
 
 def _write_model_metadata(
@@ -154,8 +243,8 @@ def _write_model_metadata(
         output_uri (Path): new output ONNX path or defaults to model_uri.
     """
     # Read JSON configuration to dictionary
-    with open(config_uri, 'r', encoding='utf-8') as fid:
-        data = json.load(fid)
+    raw = config_uri.read_bytes()
+    data = orjson.loads(raw) if orjson is not None else json.loads(raw)
 
     if 'model_uri' not in data:
         _error('Key "model_uri": "/path.onnx" is missing from the configuration.')
@@ -182,11 +271,11 @@ def _write_model_metadata(
     _metadata_validator(metadata)
 
     # Open the model, write metadata, and save the model.
-    model = onnx.load(model_uri)
+    model = onnx.load(model_uri, load_external_data=False)
     _add_metadata(model, metadata)
 
     if len(model.metadata_props) != 0:
-        onnx.save(model, output_uri)
+        _save_model(model, model_uri, output_uri)
         success = _to_color(f'Successfully wrote metadata: {output_uri}\n', 'green')
         sys.stdout.write(success)
     else:
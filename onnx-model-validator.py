@@ -3,18 +3,23 @@
 import argparse
 import itertools
 import json
-import os
 import sys
 
 from typing import Type
 from pathlib import Path
-from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
-import onnxruntime as ort
+import onnx
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 # Global variables
-REPORT = OrderedDict()
+REPORT = {}
 EXIT_STATUS_SUCCESS = 0
 EXIT_STATUS_ERROR = 1
 
@@ -27,20 +32,59 @@ def parse_layers(container: list, layers: list, group: str) -> None:
         layers (list): list of layer data to be parsed.
         group (str): str group name to store layers in the container.
     """
-    idx = 0
-    for layer in layers:
-        data = {
+    container[group] = [
+        {
             'id': idx,
             'name': layer.name,
-            'shape': layer.shape
+            'shape': layer_shape(layer)
         }
-        container[group].append(data)
-        idx += 1
+        for idx, layer in enumerate(layers)
+    ]
+
+
+def layer_shape(layer: onnx.ValueInfoProto) -> list:
+    """Collect the tensor shape of an ONNX graph input or output.
+
+    Args:
+        layer (ValueInfoProto): graph input or output layer.
+
+    Returns:
+        list: Returns a list of dimension sizes, symbolic names, or None for
+            unknown dimensions. Returns None when the shape itself is unknown,
+            a scalar is an empty list.
+    """
+    tensor_type = layer.type.tensor_type
+    if not tensor_type.HasField('shape'):
+        return None
+
+    shape = []
+    for dim in tensor_type.shape.dim:
+        if dim.HasField('dim_value'):
+            shape.append(dim.dim_value)
+        elif dim.HasField('dim_param'):
+            shape.append(dim.dim_param)
+        else:
+            shape.append(None)
+
+    return shape
+
 
+def layer_key(layer: dict) -> tuple:
+    """Build a hashable key for a parsed layer.
 
-def get_in_out_layers(model_file: str) -> dict:
-    """Instance an ONNX model using ONNX Runtime and collect model
-    inputs and outputs.
+    Args:
+        layer (dict): Parsed layer data from parse_layers.
+
+    Returns:
+        tuple: Returns an (id, name, shape) tuple identifying the layer.
+    """
+    shape = layer['shape']
+    return (layer['id'], layer['name'], None if shape is None else tuple(shape))
+
+
+def read_in_out_layers(model_file: str) -> dict:
+    """Load the ONNX model graph, without external tensor data, and collect
+    model inputs and outputs.
 
     Args:
         model_file (str): An ONNX model file path containing information needed.
@@ -48,12 +92,15 @@ def get_in_out_layers(model_file: str) -> dict:
     Returns:
         dict: Returns a dictionary of input and output data lists.
     """
-    model = ort.InferenceSession(
-        model_file,
-        providers=['CPUExecutionProvider']
-    )
-    input_layers = model.get_inputs()
-    output_layers = model.get_outputs()
+    model = onnx.load(model_file, load_external_data=False)
+
+    # Fill in undeclared input and output shapes, as ONNX Runtime reports them
+    model = onnx.shape_inference.infer_shapes(model)
+
+    # Initializers listed as graph inputs are weights, not model inputs
+    initializers = {init.name for init in model.graph.initializer}
+    input_layers = [vi for vi in model.graph.input if vi.name not in initializers]
+    output_layers = list(model.graph.output)
 
     layer_data = {
         'inputs': [],
@@ -62,10 +109,40 @@ def get_in_out_layers(model_file: str) -> dict:
 
     parse_layers(layer_data, input_layers, 'inputs')
     parse_layers(layer_data, output_layers, 'outputs')
+    del model
 
     return layer_data
 
 
+@lru_cache(maxsize=32)
+def _cached_in_out_layers(model_file: str, mtime_ns: int) -> dict:
+    """Cache parsed layers per model file, the modification time invalidates
+    entries for models rewritten on disk.
+
+    Args:
+        model_file (str): Resolved ONNX model file path.
+        mtime_ns (int): Model file modification time in nanoseconds.
+
+    Returns:
+        dict: Returns a dictionary of input and output data lists.
+    """
+    return read_in_out_layers(model_file)
+
+
+def get_in_out_layers(model_path: Path) -> dict:
+    """Collect model inputs and outputs, reusing previously parsed results
+    for unchanged model files. The returned dictionary is shared with the
+    cache and must not be mutated by callers.
+
+    Args:
+        model_path (Path): A resolved ONNX model file path.
+
+    Returns:
+        dict: Returns a dictionary of input and output data lists.
+    """
+    return _cached_in_out_layers(str(model_path), model_path.stat().st_mtime_ns)
+
+
 def diff_models(a: list, b: list, group: str) -> int:
     """Compare two ONNX models and report the differences.
 
@@ -74,36 +151,56 @@ def diff_models(a: list, b: list, group: str) -> int:
         b (list): Parsed data from an ONNX model layer.
         group (str): The associated layer group "Inputs" or "Outputs"
     """
-    a_minus_b = [item for item in a if item not in b]
-    b_minus_a = [item for item in b if item not in a]
-    sym_diff = list(itertools.chain(a_minus_b, b_minus_a))
-
+    # Matching models are the common case, list equality short-circuits on
+    # length and at the first mismatched layer before any diff is built.
     status = 0
     if a == b:
         REPORT['models']['compatability'][group] = True #f'Models {group} Match...'
     else:
         REPORT['models']['compatability'][group] = False #f'Model {group} do not match'
 
+        # Hash based difference preserving the original layer order
+        keys_a = [layer_key(item) for item in a]
+        keys_b = [layer_key(item) for item in b]
+        set_a = set(keys_a)
+        set_b = set(keys_b)
+        a_minus_b = [item for item, key in zip(a, keys_a) if key not in set_b]
+        b_minus_a = [item for item, key in zip(b, keys_b) if key not in set_a]
+        sym_diff = list(itertools.chain(a_minus_b, b_minus_a))
+
         REPORT[group] = {}
         REPORT[group]['a_vs_b'] = 'Model A contains one or more layers missing from Model B:'
-        REPORT[group]['a_layers'] = []
-        for d in a_minus_b:
-            REPORT[group]['a_layers'].append(d)
+        REPORT[group]['a_layers'] = a_minus_b
 
         REPORT[group]['b_vs_a'] = 'Model B contains one or more layers missing from Model A:'
-        REPORT[group]['b_layers'] = []
-        for d in b_minus_a:
-            REPORT[group]['b_layers'].append(d)
+        REPORT[group]['b_layers'] = b_minus_a
 
-        REPORT[group]['symantic_difference'] = []
-        for d in sym_diff:
-            REPORT[group]['symantic_difference'].append(d)
+        REPORT[group]['symantic_difference'] = sym_diff
 
         status = 1
 
     return status
 
 
+def write_report(output_uri: str, indent: int) -> None:
+    """Write the global report to a JSON file. Uses orjson when installed,
+    which only supports an indent of 0 or 2; other indent widths fall back
+    to the standard json module.
+
+    Args:
+        output_uri (str): JSON report output file path.
+        indent (int): JSON indent width, 0 writes a compact report.
+    """
+    if orjson is not None and indent in (0, 2):
+        option = orjson.OPT_INDENT_2 if indent else 0
+        with open(output_uri, 'wb') as fid:
+            fid.write(orjson.dumps(REPORT, option=option))
+    else:
+        separators = (',', ':') if not indent else None
+        with open(output_uri, 'w', encoding='utf-8') as fid:
+            json.dump(REPORT, fid, indent=(indent or None), separators=separators)
+
+
 def cli() -> Type[argparse.Namespace]:
     """Application CLI.
 
@@ -162,26 +259,32 @@ def main() -> None:
     """
     args = cli()
 
-    if args.model_a.is_file():
-        model_a = str(args.model_a)
+    # Resolve once and reuse the paths for loading and the report
+    model_a = args.model_a.resolve()
+    model_b = args.model_b.resolve()
 
-    if args.model_b.is_file():
-        model_b = str(args.model_b)
+    for model in (model_a, model_b):
+        if not model.is_file():
+            sys.stderr.write(f'Error: Invalid model file: {model}\n')
+            sys.exit(EXIT_STATUS_ERROR)
 
     if args.output_uri is not None:
         if not str(args.output_uri).endswith('.json'):
             args.output_uri = f'{args.output_uri}.json'
 
     REPORT['models'] = {}
-    REPORT['models']['model_a'] = os.path.abspath(model_a)
-    REPORT['models']['model_b'] = os.path.abspath(model_b)
+    REPORT['models']['model_a'] = model_a.as_posix()
+    REPORT['models']['model_b'] = model_b.as_posix()
     REPORT['models']['compatability'] = {}
 
     layer_type = args.layer_type.upper()
     indent = args.indent
 
-    a_layers = get_in_out_layers(model_a)
-    b_layers = get_in_out_layers(model_b)
+    # Load both models concurrently, file reads release the GIL
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_a = executor.submit(get_in_out_layers, model_a)
+        future_b = executor.submit(get_in_out_layers, model_b)
+        a_layers, b_layers = future_a.result(), future_b.result()
 
     if layer_type in ('BOTH', 'INPUTS'):
         input_status = diff_models(a_layers['inputs'], b_layers['inputs'], 'Inputs')
@@ -195,9 +298,7 @@ def main() -> None:
     REPORT['exit_status'] = status
 
     # Write report
-    output = json.dumps(REPORT, indent=indent)
-    with open(args.output_uri, 'w', encoding='utf-8') as fid:
-        fid.write(output)
+    write_report(args.output_uri, indent)
 
     sys.exit(status)
 